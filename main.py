@@ -1,16 +1,27 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
 import re
-from scout import main as scout_main
+from scout import main as scout_main, create_session
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Share one HTTP session (connection pool, DNS and TLS cache) across requests
+    async with create_session() as session:
+        app.state.session = session
+        yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Config
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+CAS_RE = re.compile(r'\d{2,7}-\d{2}-\d')
+
 @app.get("/")
 def home():
     return {"message": "Welcome to the Scout Crawler API"}
@@ -20,13 +31,12 @@ async def run_scout(cas_or_name: str):
     if not cas_or_name:
         raise HTTPException(status_code=400, detail="No input provided.")
     
-    cas_pattern = r'^\d{2,7}-\d{2}-\d$'
-    match = re.match(cas_pattern, cas_or_name)
+    match = CAS_RE.fullmatch(cas_or_name)
     
     input_data = [{"cas": cas_or_name}] if match else [{"name": cas_or_name}]
     
     try:
-        response = await scout_main(input_data)
+        response = await scout_main(input_data, app.state.session)
         if not response:
             raise HTTPException(status_code=404, detail="No PDF found or verification failed.")
         
@@ -39,9 +49,5 @@ async def run_scout(cas_or_name: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/files/{filename}")
-async def get_file(filename: str):
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    raise HTTPException(status_code=404, detail="File not found")
+# Serve downloaded PDFs, StaticFiles rejects paths outside UPLOAD_DIR
+app.mount("/files", StaticFiles(directory=UPLOAD_DIR), name="files")
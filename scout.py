@@ -1,10 +1,17 @@
 import os
 import re
+import asyncio
+import time
+import threading
+import uuid
 from datetime import datetime
+from functools import lru_cache
+from collections import Counter
+from urllib.parse import urlparse, urldefrag
 import fitz  # PyMuPDF
-import requests
 from googlesearch import search
 import aiohttp
+import aiofiles
 import json
 
 # Directories setup
@@ -43,27 +50,62 @@ SKIP_URLS = set([
     "bulkOrder", "cart", "pinterest", "scribd",
 ])
 
-# URL visit count dictionary
-URL_VISIT_COUNT = {}
-DOMAIN_VISIT_COUNT = {}
-MAX_URL_VISITS = 5
-MAX_DOMAIN_VISITS = 5
+# PyMuPDF is not thread safe, only one thread may use it at a time
+PDF_LOCK = threading.Lock()
+
+# Phrase every verified PDF must contain
+SDS_PHRASE = "safety data sheet"
 
 # Limit for downloading files
 DOWNLOAD_LIMIT = 5
-DOWNLOADED_FILES_COUNT = 0
+
+# Connection pool and in-flight request limits
+MAX_CONNECTIONS = 20
+MAX_CONNECTIONS_PER_HOST = 5
+DNS_CACHE_TTL = 300
+
+# Pipeline workers, downloaders also bound the number of in-flight requests
+DOWNLOAD_WORKERS = 10
+VERIFY_WORKERS = 1  # PDF_LOCK lets only one verification run at a time
+
+# Queries from one batch that may run at the same time
+MAX_CONCURRENT_QUERIES = 4
+
+# Google Custom Search JSON API, the googlesearch scraper is used when unset
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+GOOGLE_CSE_ID = os.environ.get("GOOGLE_CSE_ID")
+GOOGLE_CSE_URL = "https://www.googleapis.com/customsearch/v1"
+CSE_PAGE_SIZE = 10  # maximum results the API returns per request
+SEARCH_RESULTS = 20
+
+# URLs recently seen serving HTML instead of a PDF, reused across queries
+NON_PDF_CACHE = {}
+NON_PDF_CACHE_TTL = 900
+NON_PDF_CACHE_SIZE = 1024
+
+# Chunk size used when streaming PDFs to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Create the HTTP session shared by all downloads
+def create_session():
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONNECTIONS,
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+    return aiohttp.ClientSession(connector=connector)
 
 # Save report to JSON file
-def save_report(report_list):
+async def save_report(report_list):
     if report_list:
         try:
             json_string = json.dumps(report_list, indent=4)
             report_filename = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".json"
             report_filename = os.path.join(LOGS_FOLDER, report_filename)
-            with open(report_filename, "w") as report_file:
-                report_file.write(json_string)
+            async with aiofiles.open(report_filename, "w") as report_file:
+                await report_file.write(json_string)
             print(f"Scout report generated, check {report_filename}")
-            return json.loads(json_string)
+            return report_list
         except Exception as e:
             print(f"An error occurred while generating the report: {e}")
     else:
@@ -82,90 +124,266 @@ def add_report(report_list, cas, name, filepath, verified, provider, url):
     }
     report_list.append(report)
 
-# Check if URL is a PDF
-def is_pdf(url):
-    try:
-        if url.endswith(".pdf"):
+# Per query bookkeeping of visited URLs and downloaded files
+class ScoutContext:
+    def __init__(self):
+        self.url_counter = Counter()
+        self.downloaded = 0
+        self.lock = asyncio.Lock()
+
+    # Count a visit, False when the URL was already seen in this query
+    def visit(self, url):
+        key = urldefrag(url).url
+        self.url_counter[key] += 1
+        return self.url_counter[key] == 1
+
+    # Check if the download limit has been reached
+    def limit_reached(self):
+        return self.downloaded >= DOWNLOAD_LIMIT
+
+    # Reserve a download slot, False once the limit is reached
+    async def reserve_download(self):
+        async with self.lock:
+            if self.limit_reached():
+                return False
+            self.downloaded += 1
             return True
-        response = requests.head(url, timeout=10)
-        content_type = response.headers.get("content-type")
-        return content_type == "application/pdf"
-    except requests.Timeout:
-        print(f"Timeout occurred while checking {url}")
-        return False
-    except Exception as e:
-        print(f"Error occurred while checking {url}: {e}")
-        return False
 
-# Download PDF from URL
-async def download_pdf(session, url):
-    global DOWNLOADED_FILES_COUNT
+    # Give back a download slot that did not produce a file
+    async def release_download(self):
+        async with self.lock:
+            self.downloaded -= 1
+
+# Check if URL was recently seen serving HTML instead of a PDF
+def is_cached_non_pdf(url):
+    cached_at = NON_PDF_CACHE.get(urldefrag(url).url)
+    return cached_at is not None and time.monotonic() - cached_at < NON_PDF_CACHE_TTL
+
+# Remember that URL serves HTML, evicting the oldest entry when full
+def cache_non_pdf(url):
+    key = urldefrag(url).url
+    NON_PDF_CACHE.pop(key, None)
+    NON_PDF_CACHE[key] = time.monotonic()
+    if len(NON_PDF_CACHE) > NON_PDF_CACHE_SIZE:
+        del NON_PDF_CACHE[next(iter(NON_PDF_CACHE))]
+
+# Check if the URL path, ignoring query string and fragment, names a PDF file
+def has_pdf_path(url):
+    return urlparse(url).path.lower().endswith(".pdf")
+
+# Check if a response is a PDF, trusting the URL path for generic binary responses
+def is_pdf_response(url, content_type):
+    if content_type.startswith('application/pdf'):
+        return True
+    return content_type.startswith('application/octet-stream') and has_pdf_path(url)
+
+# Download PDF from URL, skipping responses that are not PDFs
+async def download_pdf(session, url, context):
+    if is_cached_non_pdf(url):
+        print(f"Skipping {url}, not a PDF file (cached).")
+        return None
+    if context.limit_reached():
+        print("Download limit reached.")
+        return None
     try:
         async with session.get(url, timeout=10) as response:
             response.raise_for_status()
-            if response.headers.get('content-type') == 'application/pdf':
-                file_name = url.split("/")[-1]
-                if not file_name.endswith(".pdf"):
-                    file_name += ".pdf"
-                file_path = os.path.join(TEMP_FOLDER, file_name)
-                with open(file_path, 'wb') as pdf_file:
-                    pdf_file.write(await response.read())
-                print(f"Downloaded: {file_name}")
-                DOWNLOADED_FILES_COUNT += 1
-                return file_path
-            else:
+            content_type = response.headers.get('content-type', '')
+            if not is_pdf_response(url, content_type):
+                # Only a direct HTML answer is cached, redirects may lead to login or cookie walls
+                if content_type.startswith('text/html') and not response.history:
+                    cache_non_pdf(url)
                 print(f"Skipping {url}, not a PDF file.")
                 return None
+            if not await context.reserve_download():
+                print("Download limit reached.")
+                return None
+            # Prefix a unique id, concurrent downloads often share names like sds.pdf
+            file_name = urlparse(url).path.split("/")[-1]
+            if not file_name.lower().endswith(".pdf"):
+                file_name += ".pdf"
+            file_name = f"{uuid.uuid4().hex}_{file_name}"
+            file_path = os.path.join(TEMP_FOLDER, file_name)
+            # Write to a temporary name so a failed or cancelled download never leaves a partial PDF
+            part_path = file_path + ".part"
+            try:
+                async with aiofiles.open(part_path, 'wb') as pdf_file:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await pdf_file.write(chunk)
+                os.replace(part_path, file_path)
+            except BaseException:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                await context.release_download()
+                raise
+            print(f"Downloaded: {file_name}")
+            return file_path
     except Exception as e:
         print(f"An error occurred while downloading {url}: {e}")
     return None
 
-# Extract text from PDF
-def extract_text_from_pdf(pdf_path):
+# Delete a downloaded PDF that will not be reported
+def remove_pdf(file_path):
     try:
-        pageno = 1
-        doc = fitz.open(pdf_path)
-        text = ""
-        for page in doc:
-            if pageno > 5:  # read only first 5 pages
-                break
-            text += page.get_text()
-            pageno += 1
-        doc.close()
-        return text
-    except Exception as e:
-        print(f"An error occurred while extracting text from {pdf_path}: {e}")
-        return None
+        os.remove(file_path)
+    except OSError as e:
+        print(f"An error occurred while removing {file_path}: {e}")
 
 # Set regular expression pattern
+@lru_cache(maxsize=1024)
 def set_pattern(sequence):
     escaped_sequence = re.escape(sequence)
     return re.compile(rf'\b{escaped_sequence}\b', re.IGNORECASE)
 
-# Verify PDF content
+# Verify PDF content, stopping at the first page where every term has been found
 def verify_pdf(file_path, cas=None, name=None):
+    sequences = []
+    if cas:
+        sequences.append(cas)
+    if name:
+        sequences.append(name)
     try:
-        text = extract_text_from_pdf(file_path)
-        if text is None:
-            print(f"Failed to extract text from PDF: {file_path}")
-            return False
-        patterns = [set_pattern("safety data sheet")]
-        if cas:
-            patterns.append(set_pattern(cas))
-        if name:
-            patterns.append(set_pattern(name))
-
-        verified = all(pattern.search(text) for pattern in patterns)
-        if verified:
-            print(f"PDF verified successfully: {file_path}")
-            return True
+        with PDF_LOCK, fitz.open(file_path) as doc:
+            phrase_found = False
+            pending = [set_pattern(sequence) for sequence in sequences]
+            for pageno, page in enumerate(doc):
+                if pageno >= 5:  # read only first 5 pages
+                    break
+                textpage = page.get_textpage()
+                # The fixed phrase only needs PyMuPDF's case-insensitive literal search
+                if not phrase_found:
+                    phrase_found = bool(page.search_for(SDS_PHRASE, textpage=textpage))
+                # CAS and name need the regex, which enforces word boundaries
+                if pending:
+                    text = page.get_text(textpage=textpage)
+                    pending = [pattern for pattern in pending if not pattern.search(text)]
+                if phrase_found and not pending:
+                    print(f"PDF verified successfully: {file_path}")
+                    return True
     except Exception as e:
         print(f"An error occurred while verifying {file_path}: {e}")
     print(f"PDF verification failed: {file_path}")
     return False
 
+# Fetch one page of Custom Search results
+async def search_cse_page(session, query, start):
+    params = {
+        "key": GOOGLE_API_KEY,
+        "cx": GOOGLE_CSE_ID,
+        "q": query,
+        "num": CSE_PAGE_SIZE,
+        "start": start,
+    }
+    async with session.get(GOOGLE_CSE_URL, params=params, timeout=10) as response:
+        response.raise_for_status()
+        data = await response.json()
+    return [item["link"] for item in data.get("items", [])]
+
+# Search for result URLs, fetching further Custom Search pages only when the first is full
+async def search_cse(session, query, num_results=SEARCH_RESULTS):
+    # A failing first page means a bad key, quota or query, so report it like a scraper error
+    urls = await search_cse_page(session, query, 1)
+    if len(urls) < CSE_PAGE_SIZE or num_results <= CSE_PAGE_SIZE:
+        return urls[:num_results]
+    pages = await asyncio.gather(
+        *(search_cse_page(session, query, start)
+          for start in range(1 + CSE_PAGE_SIZE, num_results + 1, CSE_PAGE_SIZE)),
+        return_exceptions=True,
+    )
+    for page in pages:
+        if isinstance(page, Exception):
+            print(f"An error occurred while searching for {query}: {page}")
+            continue
+        urls.extend(page)
+    return urls[:num_results]
+
+# Scrape result URLs in a worker thread, yielding each one as soon as it is found
+async def scrape_search_urls(query, num_results=SEARCH_RESULTS):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def drain():
+        try:
+            for url in search(query, num_results=num_results):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, url)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    future = loop.run_in_executor(None, drain)
+    try:
+        while True:
+            url = await queue.get()
+            if url is None:
+                break
+            yield url
+        await future  # surface search errors
+    finally:
+        stop.set()
+
+# Yield search result URLs from Custom Search, or the scraper when it is not configured
+async def search_urls(session, query, num_results=SEARCH_RESULTS):
+    if GOOGLE_API_KEY and GOOGLE_CSE_ID:
+        for url in await search_cse(session, query, num_results):
+            yield url
+    else:
+        async for url in scrape_search_urls(query, num_results):
+            yield url
+
+# Search stage: queue the results worth downloading, then one sentinel per worker
+async def produce_urls(session, query, context, url_queue, workers):
+    try:
+        async for result_url in search_urls(session, query):
+            if not context.visit(result_url):
+                print(f"Duplicate result, skipping URL: {result_url}")
+                continue
+            url_queue.put_nowait(result_url)
+    finally:
+        for _ in range(workers):
+            url_queue.put_nowait(None)
+
+# Download stage: fetch queued URLs and pass downloaded PDFs on
+async def download_worker(session, context, url_queue, pdf_queue):
+    while True:
+        url = await url_queue.get()
+        if url is None:
+            return
+        file_path = await download_pdf(session, url, context)
+        if file_path:
+            await pdf_queue.put((url, file_path))
+        else:
+            print(f"No PDF downloaded from: {url}")
+
+# Verify stage: return the first downloaded PDF that passes verification
+async def verify_worker(pdf_queue, cas=None, name=None):
+    while True:
+        item = await pdf_queue.get()
+        if item is None:
+            return None
+        url, file_path = item
+        print(f"Verifying downloaded PDF: {file_path}")
+        try:
+            # The thread keeps the event loop free, PDF_LOCK serialises the PyMuPDF work itself
+            verified = await asyncio.to_thread(verify_pdf, file_path, cas, name)
+        except BaseException:
+            remove_pdf(file_path)
+            raise
+        if verified:
+            print(f"Verified PDF: {file_path}")
+            return url, file_path
+        print(f"Verification failed for: {file_path}")
+        remove_pdf(file_path)
+
+# Send the verifiers their sentinels once every downloader has finished
+async def close_pdf_queue(downloaders, pdf_queue, workers):
+    await asyncio.gather(*downloaders)
+    for _ in range(workers):
+        await pdf_queue.put(None)
+
 # Download and verify PDFs for CAS number or name
-async def download_and_verify_pdfs(cas=None, name=None, url=None):
+async def download_and_verify_pdfs(session, cas=None, name=None, url=None):
     if cas:
         query = f'"{cas}" "safety data sheet" filetype:pdf'
         print(f"Querying for CAS: {query}")
@@ -179,49 +397,81 @@ async def download_and_verify_pdfs(cas=None, name=None, url=None):
         print("ERROR: CAS number or name or URL not provided.")
         return []
 
-    global DOWNLOADED_FILES_COUNT
-    DOWNLOADED_FILES_COUNT = 0
     report_list = []
 
-    async with aiohttp.ClientSession() as session:
-        for url in search(query, num_results=20):
-            if DOWNLOADED_FILES_COUNT >= DOWNLOAD_LIMIT:
-                print("Download limit reached.")
-                break
-            if is_pdf(url):
-                print(f"Found PDF URL: {url}")
-                file_path = await download_pdf(session, url)
-                if file_path:
-                    print(f"Verifying downloaded PDF: {file_path}")
-                    if verify_pdf(file_path, cas, name):
-                        print(f"Verified PDF: {file_path}")
-                        add_report(report_list, cas, name, file_path, True, url, url)
-                        return report_list  # Return the report list here
-                    else:
-                        print(f"Verification failed for: {file_path}")
-                else:
-                    print(f"Failed to download PDF from: {url}")
-            else:
-                print(f"URL is not a PDF: {url}")
+    context = ScoutContext()
+    url_queue = asyncio.Queue()
+    pdf_queue = asyncio.Queue()
+
+    producer = asyncio.create_task(produce_urls(session, query, context, url_queue, DOWNLOAD_WORKERS))
+    downloaders = [
+        asyncio.create_task(download_worker(session, context, url_queue, pdf_queue))
+        for _ in range(DOWNLOAD_WORKERS)
+    ]
+    verifiers = [
+        asyncio.create_task(verify_worker(pdf_queue, cas, name))
+        for _ in range(VERIFY_WORKERS)
+    ]
+    closer = asyncio.create_task(close_pdf_queue(downloaders, pdf_queue, VERIFY_WORKERS))
+    tasks = [producer, closer, *downloaders, *verifiers]
+    try:
+        # Take the first verified PDF and drop the rest of the pipeline
+        for next_done in asyncio.as_completed(verifiers):
+            result = await next_done
+            if result:
+                pdf_url, file_path = result
+                add_report(report_list, cas, name, file_path, True, pdf_url, pdf_url)
+                return report_list  # Return the report list here
+        await producer  # surface search errors
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Downloads still waiting for a verifier are never reported
+        while not pdf_queue.empty():
+            item = pdf_queue.get_nowait()
+            if item:
+                remove_pdf(item[1])
     print(f"No valid PDFs found for query: {query}")
     return report_list
 
-# Main function
-async def main(input_data):
-    global DOWNLOADED_FILES_COUNT
-    DOWNLOADED_FILES_COUNT = 0
-    report_list = []
+# Run one query while holding a slot of the batch semaphore
+async def bounded_download_and_verify_pdfs(semaphore, session, cas=None, name=None, url=None):
+    async with semaphore:
+        return await download_and_verify_pdfs(session, cas, name, url)
+
+# Main function, creates a temporary session when none is given
+async def main(input_data, session=None):
+    if session is None:
+        async with create_session() as session:
+            return await main(input_data, session)
+
+    queries = []
     for data in input_data:
         cas = data.get("cas")
         name = data.get("name")
         urls = data.get("urls")
         if urls:
             for url in urls:
-                verified_pdf_path = await download_and_verify_pdfs(cas, name, url)
-                if verified_pdf_path:
-                    report_list.extend(verified_pdf_path)
+                queries.append((cas, name, url))
         else:
-            verified_pdf_path = await download_and_verify_pdfs(cas, name)
-            if verified_pdf_path:
-                report_list.extend(verified_pdf_path)
-    return save_report(report_list)  # Save and return the report list
+            queries.append((cas, name, None))
+
+    # Independent queries run concurrently, bounded so the connection pool is shared fairly
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+    tasks = [
+        asyncio.create_task(bounded_download_and_verify_pdfs(semaphore, session, cas, name, url))
+        for cas, name, url in queries
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        # Stop the other queries when one fails, before the session can be closed under them
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    report_list = []
+    for verified_pdf_path in results:
+        if verified_pdf_path:
+            report_list.extend(verified_pdf_path)
+    return await save_report(report_list)  # Save and return the report list